@@ -118,6 +118,18 @@ class Headers(multidict.MultiDict):  # type: ignore
 
     fields: tuple[tuple[bytes, bytes], ...]
 
+    @classmethod
+    def from_trusted_list(cls, fields: Sequence[tuple[bytes, bytes]]) -> "Headers":
+        """
+        Create headers from a sequence of ``(name, value)`` header byte tuples without validating them.
+
+        Only use this for fields that are known to be well-formed,
+        e.g. because they have just been decoded by the protocol implementation.
+        """
+        headers = cls.__new__(cls)
+        headers.fields = tuple(fields)
+        return headers
+
     @staticmethod
     def _reduce_values(values) -> str:
         # Headers can be folded
@@ -3,6 +3,7 @@ from __future__ import annotations
 import re
 import urllib.parse
 from collections.abc import Sequence
+from functools import lru_cache
 from typing import AnyStr
 
 from mitmproxy.net import check
@@ -155,6 +156,8 @@ def default_port(scheme: AnyStr) -> int | None:
     }.get(scheme, None)
 
 
+# Requests on the same connection almost always share their authority, so we cache the parse result.
+@lru_cache(256)
 def parse_authority(authority: AnyStr, check: bool) -> tuple[str, int | None]:
     """Extract the host and port from host header/authority information
 
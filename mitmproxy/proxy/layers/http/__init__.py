@@ -143,8 +143,8 @@ class DropStream(HttpCommand):
 
 
 class HttpStream(layer.Layer):
-    request_body_buf: bytes
-    response_body_buf: bytes
+    request_body_buf: bytearray
+    response_body_buf: bytearray
     flow: http.HTTPFlow
     stream_id: StreamId
     child_layer: layer.Layer | None = None
@@ -158,8 +158,8 @@ class HttpStream(layer.Layer):
 
     def __init__(self, context: Context, stream_id: int) -> None:
         super().__init__(context)
-        self.request_body_buf = b""
-        self.response_body_buf = b""
+        self.request_body_buf = bytearray()
+        self.response_body_buf = bytearray()
         self.client_state = self.state_uninitialized
         self.server_state = self.state_uninitialized
         self.stream_id = stream_id
@@ -352,8 +352,8 @@ class HttpStream(layer.Layer):
             self.flow.request.trailers = event.trailers
         elif isinstance(event, RequestEndOfMessage):
             self.flow.request.timestamp_end = time.time()
-            self.flow.request.data.content = self.request_body_buf
-            self.request_body_buf = b""
+            self.flow.request.data.content = bytes(self.request_body_buf)
+            self.request_body_buf.clear()
             self.client_state = self.state_done
             yield HttpRequestHook(self.flow)
             if (yield from self.check_killed(True)):
@@ -459,8 +459,8 @@ class HttpStream(layer.Layer):
             self.flow.response.trailers = event.trailers
         elif isinstance(event, ResponseEndOfMessage):
             assert self.flow.response
-            self.flow.response.data.content = self.response_body_buf
-            self.response_body_buf = b""
+            self.flow.response.data.content = bytes(self.response_body_buf)
+            self.response_body_buf.clear()
             yield from self.send_response()
 
     def send_response(self, already_streamed: bool = False):
@@ -605,16 +605,16 @@ class HttpStream(layer.Layer):
                 self.flow.request.stream = True
                 if self.request_body_buf:
                     # clear buffer and then fake a DataReceived event with everything we had in the buffer so far.
-                    body_buf = self.request_body_buf
-                    self.request_body_buf = b""
+                    body_buf = bytes(self.request_body_buf)
+                    self.request_body_buf.clear()
                     yield from self.start_request_stream()
                     yield from self.handle_event(RequestData(self.stream_id, body_buf))
             if response:
                 assert self.flow.response
                 self.flow.response.stream = True
                 if self.response_body_buf:
-                    body_buf = self.response_body_buf
-                    self.response_body_buf = b""
+                    body_buf = bytes(self.response_body_buf)
+                    self.response_body_buf.clear()
                     yield from self.start_response_stream()
                     yield from self.handle_event(ResponseData(self.stream_id, body_buf))
         return False
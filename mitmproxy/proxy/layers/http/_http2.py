@@ -604,13 +604,13 @@ class Http2Client(Http2Connection):
 
 
 def split_pseudo_headers(
-    h2_headers: Sequence[tuple[bytes, bytes]]
+    h2_headers: Sequence[tuple[bytes, bytes]], trusted: bool = False
 ) -> tuple[dict[bytes, bytes], http.Headers]:
     pseudo_headers: dict[bytes, bytes] = {}
     i = 0
     for header, value in h2_headers:
         if header.startswith(b":"):
-            if header in pseudo_headers:
+            if not trusted and header in pseudo_headers:
                 raise ValueError(f"Duplicate HTTP/2 pseudo header: {header!r}")
             pseudo_headers[header] = value
             i += 1
@@ -618,16 +618,24 @@ def split_pseudo_headers(
             # Pseudo-headers must be at the start, we are done here.
             break
 
-    headers = http.Headers(h2_headers[i:])
+    if trusted:
+        headers = http.Headers.from_trusted_list(h2_headers[i:])
+    else:
+        headers = http.Headers(h2_headers[i:])
 
     return pseudo_headers, headers
 
 
 def parse_h2_request_headers(
-    h2_headers: Sequence[tuple[bytes, bytes]]
+    h2_headers: Sequence[tuple[bytes, bytes]], trusted: bool = False
 ) -> tuple[str, int, bytes, bytes, bytes, bytes, http.Headers]:
-    """Split HTTP/2 pseudo-headers from the actual headers and parse them."""
-    pseudo_headers, headers = split_pseudo_headers(h2_headers)
+    """
+    Split HTTP/2 pseudo-headers from the actual headers and parse them.
+
+    If `trusted` is set, the headers have already been validated by the protocol stack
+    (e.g. aioquic for HTTP/3), and checks that it guarantees are skipped.
+    """
+    pseudo_headers, headers = split_pseudo_headers(h2_headers, trusted)
 
     try:
         method: bytes = pseudo_headers.pop(b":method")
@@ -654,10 +662,15 @@ def parse_h2_request_headers(
 
 
 def parse_h2_response_headers(
-    h2_headers: Sequence[tuple[bytes, bytes]]
+    h2_headers: Sequence[tuple[bytes, bytes]], trusted: bool = False
 ) -> tuple[int, http.Headers]:
-    """Split HTTP/2 pseudo-headers from the actual headers and parse them."""
-    pseudo_headers, headers = split_pseudo_headers(h2_headers)
+    """
+    Split HTTP/2 pseudo-headers from the actual headers and parse them.
+
+    If `trusted` is set, the headers have already been validated by the protocol stack
+    (e.g. aioquic for HTTP/3), and checks that it guarantees are skipped.
+    """
+    pseudo_headers, headers = split_pseudo_headers(h2_headers, trusted)
 
     try:
         status_code: int = int(pseudo_headers.pop(b":status"))
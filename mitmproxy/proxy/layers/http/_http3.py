@@ -1,9 +1,13 @@
 import time
 from abc import abstractmethod
+from collections.abc import Callable
+from typing import Any
+from typing import TypeVar
 
 from aioquic.h3.connection import ErrorCode as H3ErrorCode
 from aioquic.h3.connection import FrameUnexpected as H3FrameUnexpected
 from aioquic.h3.events import DataReceived
+from aioquic.h3.events import H3Event
 from aioquic.h3.events import HeadersReceived
 from aioquic.h3.events import PushPromiseReceived
 
@@ -42,6 +46,36 @@ from mitmproxy.proxy.layers.quic import QuicStreamEvent
 from mitmproxy.proxy.layers.quic import StopQuicStream
 from mitmproxy.proxy.utils import expect
 
+T = TypeVar("T")
+
+# mapping between mitmproxy's protocol error codes and HTTP/3 stream error codes
+_CANCEL_TO_H3: dict[int, int] = {
+    status_codes.CLIENT_CLOSED_REQUEST: H3ErrorCode.H3_REQUEST_CANCELLED.value,
+}
+_H3_TO_CANCEL: dict[int, int] = {
+    H3ErrorCode.H3_REQUEST_CANCELLED.value: status_codes.CLIENT_CLOSED_REQUEST,
+}
+
+# static headers of the error responses we generate ourselves
+_ERROR_HEADERS_STATIC = (
+    (b"server", version.MITMPROXY.encode()),
+    (b"content-type", b"text/html"),
+)
+
+
+def _collect(gen: layer.CommandGenerator[T], cmds: list[commands.Command]) -> T:
+    """
+    Run a command generator to completion, appending its commands to `cmds`, and return its result.
+    Only use this for generators that never yield blocking commands, as no replies are sent back.
+    """
+    while True:
+        try:
+            cmd = next(gen)
+        except StopIteration as e:
+            return e.value
+        assert not cmd.blocking, f"Unexpected blocking command: {cmd}"
+        cmds.append(cmd)
+
 
 class Http3Connection(HttpConnection):
     h3_conn: LayeredH3Connection
@@ -51,158 +85,239 @@ class Http3Connection(HttpConnection):
     ReceiveProtocolError: type[RequestProtocolError | ResponseProtocolError]
     ReceiveTrailers: type[RequestTrailers | ResponseTrailers]
 
+    _closed: bool = False
+    """Set once the QUIC connection is closed, all further events are ignored."""
+    _now: float | None = None
+    """The time at which the currently processed QUIC stream event arrived, shared by all its H3 events."""
+
     def __init__(self, context: context.Context, conn: connection.Connection):
         super().__init__(context, conn)
         self.h3_conn = LayeredH3Connection(
             self.conn, is_client=self.conn is self.context.server
         )
         self._stream_protocol_errors: dict[int, int] = {}
+        # dispatch on the exact event type instead of walking an isinstance chain for every event
+        # (mypy cannot tie each handler's event type to its key, so the keys need to be kept in sync by hand)
+        self._http_event_handlers: dict[
+            type[HttpEvent], Callable[[Any], list[commands.Command] | None]
+        ] = {
+            RequestData: self._send_data,
+            ResponseData: self._send_data,
+            RequestHeaders: self._send_request_headers,
+            ResponseHeaders: self._send_response_headers,
+            RequestTrailers: self._send_trailers,
+            ResponseTrailers: self._send_trailers,
+            RequestEndOfMessage: self._send_end_of_message,
+            ResponseEndOfMessage: self._send_end_of_message,
+            RequestProtocolError: self._send_protocol_error,
+            ResponseProtocolError: self._send_protocol_error,
+        }
+        self._h3_event_handlers: dict[
+            type[H3Event], Callable[[Any, list[ReceiveHttp]], None]
+        ] = {
+            StreamReset: self._receive_stream_reset,
+            DataReceived: self._receive_data,
+            HeadersReceived: self._receive_headers,
+            TrailersReceived: self._receive_trailers,
+            PushPromiseReceived: self._receive_push_promise,
+        }
 
     def _handle_event(self, event: events.Event) -> layer.CommandGenerator[None]:
-        if isinstance(event, events.Start):
-            yield from self.h3_conn.transmit()
+        # Events must be handled strictly in the order the layer driver delivers them.
+        # A QuicStreamEvent only ever concerns a single stream, and reordering across events
+        # (e.g. letting a close overtake pending data) would lose data or send frames in an invalid stream state.
+        if self._closed:
+            yield from self.done(event)
+            return
+
+        # forward stream messages from the QUIC layer to the H3 connection
+        # (checked first as this is by far the most frequent event)
+        if isinstance(event, QuicStreamEvent):
+            h3 = self.h3_conn
+            h3_events = h3.handle_stream_event(event)
+            stream_error = self._stream_protocol_errors.get(event.stream_id)
+            if stream_error is not None:
+                # we already reset or ended the stream, tell the peer to stop
+                # (this is a noop if the peer already did the same)
+                yield StopQuicStream(self.conn, event.stream_id, stream_error)
+            else:
+                # collect all events of this QUIC packet first and hand them out in one go
+                out: list[ReceiveHttp] = []
+                get_h3_handler = self._h3_event_handlers.get
+                self._now = time.time()
+                try:
+                    for h3_event in h3_events:
+                        h3_handler = get_h3_handler(type(h3_event))
+                        if h3_handler is None:  # pragma: no cover
+                            raise AssertionError(f"Unexpected event: {event!r}")
+                        h3_handler(h3_event, out)
+                finally:
+                    # never leak this timestamp into later events if a handler fails
+                    self._now = None
+                self._translate_received(out)
+                yield from out
+            yield from h3.transmit()
 
         # send mitmproxy HTTP events over the H3 connection
         elif isinstance(event, HttpEvent):
+            handler = self._http_event_handlers.get(type(event))
+            if handler is None:  # pragma: no cover
+                raise AssertionError(f"Unexpected event: {event!r}")
             try:
-                if isinstance(event, (RequestData, ResponseData)):
-                    self.h3_conn.send_data(event.stream_id, event.data)
-                elif isinstance(event, (RequestHeaders, ResponseHeaders)):
-                    headers = yield from (
-                        format_h2_request_headers(self.context, event)
-                        if isinstance(event, RequestHeaders)
-                        else format_h2_response_headers(self.context, event)
-                    )
-                    self.h3_conn.send_headers(
-                        event.stream_id, headers, end_stream=event.end_stream
-                    )
-                elif isinstance(event, (RequestTrailers, ResponseTrailers)):
-                    self.h3_conn.send_trailers(
-                        event.stream_id, [*event.trailers.fields]
-                    )
-                elif isinstance(event, (RequestEndOfMessage, ResponseEndOfMessage)):
-                    self.h3_conn.end_stream(event.stream_id)
-                elif isinstance(event, (RequestProtocolError, ResponseProtocolError)):
-                    code = {
-                        status_codes.CLIENT_CLOSED_REQUEST: H3ErrorCode.H3_REQUEST_CANCELLED.value,
-                    }.get(event.code, H3ErrorCode.H3_INTERNAL_ERROR.value)
-                    self._stream_protocol_errors[event.stream_id] = code
-                    send_error_message = (
-                        isinstance(event, ResponseProtocolError)
-                        and not self.h3_conn.has_sent_headers(event.stream_id)
-                        and event.code != status_codes.NO_RESPONSE
-                    )
-                    if send_error_message:
-                        self.h3_conn.send_headers(
-                            event.stream_id,
-                            [
-                                (b":status", b"%d" % event.code),
-                                (b"server", version.MITMPROXY.encode()),
-                                (b"content-type", b"text/html"),
-                            ],
-                        )
-                        self.h3_conn.send_data(
-                            event.stream_id,
-                            format_error(event.code, event.message),
-                            end_stream=True,
-                        )
-                    else:
-                        self.h3_conn.reset_stream(event.stream_id, code)
-                else:  # pragma: no cover
-                    raise AssertionError(f"Unexpected event: {event!r}")
+                cmds = handler(event)
 
             except H3FrameUnexpected as e:
                 # Http2Connection also ignores HttpEvents that violate the current stream state
                 yield commands.Log(f"Received {event!r} unexpectedly: {e}")
 
             else:
+                if cmds:
+                    yield from cmds
                 # transmit buffered data
                 yield from self.h3_conn.transmit()
 
-        # forward stream messages from the QUIC layer to the H3 connection
-        elif isinstance(event, QuicStreamEvent):
-            h3_events = self.h3_conn.handle_stream_event(event)
-            if event.stream_id in self._stream_protocol_errors:
-                # we already reset or ended the stream, tell the peer to stop
-                # (this is a noop if the peer already did the same)
-                yield StopQuicStream(
-                    self.conn,
-                    event.stream_id,
-                    self._stream_protocol_errors[event.stream_id],
-                )
-            else:
-                for h3_event in h3_events:
-                    if isinstance(h3_event, StreamReset):
-                        if h3_event.push_id is None:
-                            err_str = error_code_to_str(h3_event.error_code)
-                            err_code = {
-                                H3ErrorCode.H3_REQUEST_CANCELLED.value: status_codes.CLIENT_CLOSED_REQUEST,
-                            }.get(h3_event.error_code, self.ReceiveProtocolError.code)
-                            yield ReceiveHttp(
-                                self.ReceiveProtocolError(
-                                    h3_event.stream_id,
-                                    f"stream reset by client ({err_str})",
-                                    code=err_code,
-                                )
-                            )
-                    elif isinstance(h3_event, DataReceived):
-                        if h3_event.push_id is None:
-                            if h3_event.data:
-                                yield ReceiveHttp(
-                                    self.ReceiveData(h3_event.stream_id, h3_event.data)
-                                )
-                            if h3_event.stream_ended:
-                                yield ReceiveHttp(
-                                    self.ReceiveEndOfMessage(h3_event.stream_id)
-                                )
-                    elif isinstance(h3_event, HeadersReceived):
-                        if h3_event.push_id is None:
-                            try:
-                                receive_event = self.parse_headers(h3_event)
-                            except ValueError as e:
-                                self.h3_conn.close_connection(
-                                    error_code=H3ErrorCode.H3_GENERAL_PROTOCOL_ERROR,
-                                    reason_phrase=f"Invalid HTTP/3 request headers: {e}",
-                                )
-                            else:
-                                yield ReceiveHttp(receive_event)
-                                if h3_event.stream_ended:
-                                    yield ReceiveHttp(
-                                        self.ReceiveEndOfMessage(h3_event.stream_id)
-                                    )
-                    elif isinstance(h3_event, TrailersReceived):
-                        if h3_event.push_id is None:
-                            yield ReceiveHttp(
-                                self.ReceiveTrailers(
-                                    h3_event.stream_id, http.Headers(h3_event.trailers)
-                                )
-                            )
-                            if h3_event.stream_ended:
-                                yield ReceiveHttp(
-                                    self.ReceiveEndOfMessage(h3_event.stream_id)
-                                )
-                    elif isinstance(h3_event, PushPromiseReceived):  # pragma: no cover
-                        # we don't support push
-                        pass
-                    else:  # pragma: no cover
-                        raise AssertionError(f"Unexpected event: {event!r}")
-            yield from self.h3_conn.transmit()
-
         # report a protocol error for all remaining open streams when a connection is closed
         elif isinstance(event, QuicConnectionClosed):
-            self._handle_event = self.done  # type: ignore
-            self.h3_conn.handle_connection_closed(event)
+            self._closed = True
+            h3 = self.h3_conn
+            h3.handle_connection_closed(event)
             msg = event.reason_phrase or error_code_to_str(event.error_code)
-            for stream_id in self.h3_conn.get_open_stream_ids(push_id=None):
-                yield ReceiveHttp(self.ReceiveProtocolError(stream_id, msg))
+            receive_protocol_error = self.ReceiveProtocolError
+            out = [
+                ReceiveHttp(receive_protocol_error(stream_id, msg))
+                for stream_id in h3.get_open_stream_ids(push_id=None)
+            ]
+            self._translate_received(out)
+            yield from out
+
+        elif isinstance(event, events.Start):
+            yield from self.h3_conn.transmit()
 
         else:  # pragma: no cover
             raise AssertionError(f"Unexpected event: {event!r}")
 
+    def _send_data(self, event: RequestData | ResponseData) -> None:
+        self.h3_conn.send_data(event.stream_id, event.data)
+
+    def _send_request_headers(self, event: RequestHeaders) -> list[commands.Command]:
+        cmds: list[commands.Command] = []
+        headers = _collect(format_h2_request_headers(self.context, event), cmds)
+        self.h3_conn.send_headers(event.stream_id, headers, end_stream=event.end_stream)
+        return cmds
+
+    def _send_response_headers(self, event: ResponseHeaders) -> list[commands.Command]:
+        cmds: list[commands.Command] = []
+        headers = _collect(format_h2_response_headers(self.context, event), cmds)
+        self.h3_conn.send_headers(event.stream_id, headers, end_stream=event.end_stream)
+        return cmds
+
+    def _send_trailers(self, event: RequestTrailers | ResponseTrailers) -> None:
+        self.h3_conn.send_trailers(event.stream_id, list(event.trailers.fields))
+
+    def _send_end_of_message(
+        self, event: RequestEndOfMessage | ResponseEndOfMessage
+    ) -> None:
+        self.h3_conn.end_stream(event.stream_id)
+
+    def _send_protocol_error(
+        self, event: RequestProtocolError | ResponseProtocolError
+    ) -> None:
+        code = _CANCEL_TO_H3.get(event.code, H3ErrorCode.H3_INTERNAL_ERROR.value)
+        self._stream_protocol_errors[event.stream_id] = code
+        h3 = self.h3_conn
+        send_error_message = (
+            isinstance(event, ResponseProtocolError)
+            and not h3.has_sent_headers(event.stream_id)
+            and event.code != status_codes.NO_RESPONSE
+        )
+        if send_error_message:
+            # pylsqpack only accepts a list here
+            h3.send_headers(
+                event.stream_id,
+                [(b":status", b"%d" % event.code), *_ERROR_HEADERS_STATIC],
+            )
+            h3.send_data(
+                event.stream_id,
+                format_error(event.code, event.message),
+                end_stream=True,
+            )
+        else:
+            h3.reset_stream(event.stream_id, code)
+
+    def _receive_stream_reset(
+        self, h3_event: StreamReset, out: list[ReceiveHttp]
+    ) -> None:
+        if h3_event.push_id is None:
+            err_str = error_code_to_str(h3_event.error_code)
+            err_code = _H3_TO_CANCEL.get(
+                h3_event.error_code, self.ReceiveProtocolError.code
+            )
+            out.append(
+                ReceiveHttp(
+                    self.ReceiveProtocolError(
+                        h3_event.stream_id,
+                        f"stream reset by client ({err_str})",
+                        code=err_code,
+                    )
+                )
+            )
+
+    def _receive_data(self, h3_event: DataReceived, out: list[ReceiveHttp]) -> None:
+        if h3_event.push_id is None:
+            if h3_event.data:
+                out.append(
+                    ReceiveHttp(self.ReceiveData(h3_event.stream_id, h3_event.data))
+                )
+            if h3_event.stream_ended:
+                out.append(ReceiveHttp(self.ReceiveEndOfMessage(h3_event.stream_id)))
+
+    def _receive_headers(
+        self, h3_event: HeadersReceived, out: list[ReceiveHttp]
+    ) -> None:
+        if h3_event.push_id is None:
+            try:
+                receive_event = self.parse_headers(h3_event)
+            except ValueError as e:
+                self.h3_conn.close_connection(
+                    error_code=H3ErrorCode.H3_GENERAL_PROTOCOL_ERROR,
+                    reason_phrase=f"Invalid HTTP/3 request headers: {e}",
+                )
+            else:
+                out.append(ReceiveHttp(receive_event))
+                if h3_event.stream_ended:
+                    out.append(
+                        ReceiveHttp(self.ReceiveEndOfMessage(h3_event.stream_id))
+                    )
+
+    def _receive_trailers(
+        self, h3_event: TrailersReceived, out: list[ReceiveHttp]
+    ) -> None:
+        if h3_event.push_id is None:
+            out.append(
+                ReceiveHttp(
+                    self.ReceiveTrailers(
+                        h3_event.stream_id,
+                        # aioquic has already decoded and validated the trailers
+                        http.Headers.from_trusted_list(h3_event.trailers),
+                    )
+                )
+            )
+            if h3_event.stream_ended:
+                out.append(ReceiveHttp(self.ReceiveEndOfMessage(h3_event.stream_id)))
+
+    def _receive_push_promise(
+        self, h3_event: PushPromiseReceived, out: list[ReceiveHttp]
+    ) -> None:  # pragma: no cover
+        # we don't support push
+        pass
+
     @expect(HttpEvent, QuicStreamEvent, QuicConnectionClosed)
     def done(self, _) -> layer.CommandGenerator[None]:
         yield from ()
 
+    def _translate_received(self, out: list[ReceiveHttp]) -> None:
+        """Called with all received events right before they are handed out, a noop by default."""
+
     @abstractmethod
     def parse_headers(self, event: HeadersReceived) -> RequestHeaders | ResponseHeaders:
         pass  # pragma: no cover
@@ -218,7 +333,7 @@ class Http3Server(Http3Connection):
         super().__init__(context, context.client)
 
     def parse_headers(self, event: HeadersReceived) -> RequestHeaders | ResponseHeaders:
-        # same as HTTP/2
+        # same as HTTP/2, but aioquic has already validated the pseudo-headers
         (
             host,
             port,
@@ -227,7 +342,7 @@ class Http3Server(Http3Connection):
             authority,
             path,
             headers,
-        ) = parse_h2_request_headers(event.headers)
+        ) = parse_h2_request_headers(event.headers, trusted=True)
         request = http.Request(
             host=host,
             port=port,
@@ -239,7 +354,7 @@ class Http3Server(Http3Connection):
             headers=headers,
             content=None,
             trailers=None,
-            timestamp_start=time.time(),
+            timestamp_start=self._now or time.time(),
             timestamp_end=None,
         )
         return RequestHeaders(event.stream_id, request, end_stream=event.stream_ended)
@@ -252,33 +367,48 @@ class Http3Client(Http3Connection):
     ReceiveTrailers = ResponseTrailers
 
     our_stream_id: dict[int, int]
-    their_stream_id: dict[int, int]
+    their_stream_id: list[int]
+    """
+    Maps our stream IDs back to theirs, indexed by `our_stream_id >> 2`.
+    We only ever open client-initiated bidirectional streams, so our IDs are dense multiples of four.
+    """
 
     def __init__(self, context: context.Context):
         super().__init__(context, context.server)
         self.our_stream_id = {}
-        self.their_stream_id = {}
+        self.their_stream_id = []
 
     def _handle_event(self, event: events.Event) -> layer.CommandGenerator[None]:
         # QUIC and HTTP/3 would actually allow for direct stream ID mapping, but since we want
         # to support H2<->H3, we need to translate IDs.
         # NOTE: We always create bidirectional streams, as we can't safely infer unidirectionality.
-        if isinstance(event, HttpEvent):
+        if isinstance(event, HttpEvent) and not self._closed:
             ours = self.our_stream_id.get(event.stream_id, None)
             if ours is None:
                 ours = self.h3_conn.get_next_available_stream_id()
                 self.our_stream_id[event.stream_id] = ours
-                self.their_stream_id[ours] = event.stream_id
+                # IDs are handed out in order, so this always appends at `ours >> 2`
+                if ours >> 2 != len(self.their_stream_id):
+                    raise AssertionError(f"Unexpected stream ID: {ours}")
+                self.their_stream_id.append(event.stream_id)
             event.stream_id = ours
 
-        for cmd in super()._handle_event(event):
-            if isinstance(cmd, ReceiveHttp):
-                cmd.event.stream_id = self.their_stream_id[cmd.event.stream_id]
-            yield cmd
+        yield from super()._handle_event(event)
+
+    def _translate_received(self, out: list[ReceiveHttp]) -> None:
+        # only received events need their IDs translated back, so we do it where they are created
+        # instead of inspecting every single command
+        their_stream_id = self.their_stream_id
+        for cmd in out:
+            ours = cmd.event.stream_id
+            # anything else (e.g. a reset of a peer-initiated stream) is not ours to translate
+            if ours & 3 or ours >> 2 >= len(their_stream_id):
+                raise AssertionError(f"Unexpected stream ID: {ours}")
+            cmd.event.stream_id = their_stream_id[ours >> 2]
 
     def parse_headers(self, event: HeadersReceived) -> RequestHeaders | ResponseHeaders:
-        # same as HTTP/2
-        status_code, headers = parse_h2_response_headers(event.headers)
+        # same as HTTP/2, but aioquic has already validated the pseudo-headers
+        status_code, headers = parse_h2_response_headers(event.headers, trusted=True)
         response = http.Response(
             http_version=b"HTTP/3",
             status_code=status_code,
@@ -286,7 +416,7 @@ class Http3Client(Http3Connection):
             headers=headers,
             content=None,
             trailers=None,
-            timestamp_start=time.time(),
+            timestamp_start=self._now or time.time(),
             timestamp_end=None,
         )
         return ResponseHeaders(event.stream_id, response, event.stream_ended)
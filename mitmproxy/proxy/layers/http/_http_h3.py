@@ -1,3 +1,4 @@
+import collections
 from collections.abc import Iterable
 from dataclasses import dataclass
 
@@ -68,7 +69,7 @@ class MockQuic:
 
     def __init__(self, conn: connection.Connection, is_client: bool) -> None:
         self.conn = conn
-        self.pending_commands: list[commands.Command] = []
+        self.pending_commands: collections.deque[commands.Command] = collections.deque()
         self._next_stream_id: list[int] = [0, 1, 2, 3]
         self._is_client = is_client
 
@@ -279,7 +280,7 @@ class LayeredH3Connection(H3Connection):
         """Yields all pending commands for the upper QUIC layer."""
 
         while self._mock.pending_commands:
-            yield self._mock.pending_commands.pop(0)
+            yield self._mock.pending_commands.popleft()
 
 
 __all__ = [
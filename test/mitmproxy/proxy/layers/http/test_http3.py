@@ -14,6 +14,7 @@ from aioquic.h3.connection import Headers as H3Headers
 from aioquic.h3.connection import parse_settings
 from aioquic.h3.connection import Setting
 from aioquic.h3.connection import StreamType
+from aioquic.h3.events import DataReceived
 
 from mitmproxy import connection
 from mitmproxy import version
@@ -27,6 +28,7 @@ from mitmproxy.proxy import events
 from mitmproxy.proxy import layers
 from mitmproxy.proxy.layers import http
 from mitmproxy.proxy.layers import quic
+from mitmproxy.proxy.layers.http._http3 import _collect
 from mitmproxy.proxy.layers.http._http3 import Http3Client
 from test.mitmproxy.proxy import tutils
 
@@ -1101,6 +1103,33 @@ class TestClient:
             )
         )
 
+    def test_lowercase_headers(self, tctx: context.Context):
+        frame_factory = FrameFactory(tctx.server, is_client=False)
+        playbook = MultiPlaybook(Http3Client(tctx))
+        req = Request.make("GET", "http://example.com/", headers={"X-Foo": "bar"})
+        req.http_version = "HTTP/3"
+        assert (
+            playbook
+            << frame_factory.send_init()
+            >> frame_factory.receive_init()
+            << frame_factory.send_encoder()
+            >> frame_factory.receive_encoder()
+            >> http.RequestHeaders(1, req, end_stream=True)
+            << commands.Log(
+                "Lowercased 'X-Foo' header as uppercase is not allowed with HTTP/2."
+            )
+            << frame_factory.send_headers(
+                [
+                    (b":method", b"GET"),
+                    (b":scheme", b"http"),
+                    (b":path", b"/"),
+                    (b"x-foo", b"bar"),
+                    (b"content-length", b"0"),
+                ],
+                end_stream=True,
+            )
+        )
+
 
 def test_early_server_data(tctx: context.Context):
     playbook, cff = start_h3_client(tctx)
@@ -1130,3 +1159,46 @@ def test_early_server_data(tctx: context.Context):
         >> tutils.reply(to=request)
         << sff.send_headers(example_request_headers, end_stream=True)
     )
+
+
+def test_collect(tctx: context.Context):
+    log = commands.Log("foo")
+
+    def gen():
+        yield log
+        return 42
+
+    cmds: list[commands.Command] = []
+    assert _collect(gen(), cmds) == 42
+    assert cmds == [log]
+
+    def blocking():
+        yield commands.OpenConnection(tctx.server)
+
+    with pytest.raises(AssertionError, match="Unexpected blocking command"):
+        _collect(blocking(), [])
+
+
+@pytest.mark.parametrize("stream_id", [1, 3, 4])
+def test_translate_unknown_stream_id(tctx: context.Context, stream_id: int):
+    h3 = Http3Client(tctx)
+    h3.their_stream_id.append(1)
+    with pytest.raises(AssertionError, match="Unexpected stream ID"):
+        h3._translate_received(
+            [http.ReceiveHttp(http.ResponseProtocolError(stream_id, "reset"))]
+        )
+
+
+def test_timestamp_reset_on_error(tctx: context.Context, monkeypatch):
+    h3 = Http3Client(tctx)
+
+    def fail(h3_event, out):
+        raise ValueError("oops")
+
+    monkeypatch.setattr(
+        h3.h3_conn, "handle_stream_event", lambda event: [DataReceived(b"", 0, False)]
+    )
+    h3._h3_event_handlers[DataReceived] = fail
+    with pytest.raises(ValueError, match="oops"):
+        list(h3._handle_event(quic.QuicStreamDataReceived(tctx.server, 0, b"", False)))
+    assert h3._now is None
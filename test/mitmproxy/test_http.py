@@ -820,6 +820,12 @@ class TestHeaders:
         with pytest.raises(TypeError):
             Headers([(b"Host", "not-bytes")])
 
+    def test_from_trusted_list(self):
+        headers = Headers.from_trusted_list([(b"Host", b"example.com")])
+        assert headers.fields == ((b"Host", b"example.com"),)
+        assert headers["host"] == "example.com"
+        assert headers == Headers([(b"Host", b"example.com")])
+
     def test_set(self):
         headers = Headers()
         headers["foo"] = "1"